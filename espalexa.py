@@ -1,11 +1,17 @@
 import math
 from uuid import getnode as get_mac
+from uuid import uuid4
 import socket
 import struct
-from http.server import BaseHTTPRequestHandler, HTTPServer
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+from collections import deque, OrderedDict
 import threading
 import time
 import datetime
+import json
+import traceback
+from contextlib import contextmanager
 
 class EspalexaDevice:
 	def __init__(self, deviceName, gnCallback, deviceType, initialValue = 0):
@@ -23,6 +29,9 @@ class EspalexaDevice:
 		self.changed = 0
 		self.id = -1
 		self.colorMode = "xy"
+		self.listener = None
+		self.lock = threading.RLock()
+		self.deferDepth = 0	#>0 while an Alexa request is applied, see alexaUpdate()
 		
 	def getName(self):
 		return self.deviceName		
@@ -169,15 +178,42 @@ class EspalexaDevice:
 	def setID(self, nID):
 		self.id = nID
 		
+	def setListener(self, listener):
+		self.listener = listener
+		
+	def notifyChange(self, alexa = False):
+		if (self.listener is None) or (self.deferDepth > 0):
+			return
+		try:
+			self.listener(self, alexa)
+		except Exception:
+			traceback.print_exc()	#a failing listener must never break the setter
+			
+	#changes made inside the block are published as a single Alexa event when it ends
+	#the device lock keeps changes from other threads out of that event
+	@contextmanager
+	def alexaUpdate(self):
+		with self.lock:
+			self.deferDepth = self.deferDepth + 1
+			try:
+				yield
+			finally:
+				self.deferDepth = self.deferDepth - 1
+				self.notifyChange(True)
+		
 	def setName(self, name):
-		self.deviceName = name
+		with self.lock:
+			self.deviceName = name
+			self.notifyChange()
 		
 	def setValue(self, val):
-		if not (self.val == 0):
-			self.val_last = self.val
-		if not (val == 0):
-			self.val_last = val
-		self.val = val
+		with self.lock:
+			if not (self.val == 0):
+				self.val_last = self.val
+			if not (val == 0):
+				self.val_last = val
+			self.val = val
+			self.notifyChange()
 		
 	def setPercent(self, perc):
 		val = perc * 255
@@ -187,36 +223,166 @@ class EspalexaDevice:
 		self.setValue(val)
 		
 	def setColorXY(self, x, y):
-		self.x = x
-		self.y = y
-		
-		self.colorMode = "xy"
+		with self.lock:
+			self.x = x
+			self.y = y
+			
+			self.colorMode = "xy"
+			self.notifyChange()
 		
 	def setColor(self, hue, sat):
-		self.hue = hue
-		self.sat = sat
-		self.colorMode = "hs"
+		with self.lock:
+			self.hue = hue
+			self.sat = sat
+			self.colorMode = "hs"
+			self.notifyChange()
 		
 	def setColorCT(self, ct):
-		self.ct = ct
-		self.colorMode = "ct"
+		with self.lock:
+			self.ct = ct
+			self.colorMode = "ct"
+			self.notifyChange()
 		
 	def setColorRGB(self, r, g, b):
 		x = r * 0.664511 + g * 0.154324 + b * 0.162028
 		y = r * 0.283881 + g * 0.668433 + b * 0.047685
 		z = r * 0.000088 + g * 0.072310 + b * 0.986039
-		self.x = (x + y + z)
-		self.y = (x + y + z)
-		self.colorMode = "xy"
+		with self.lock:
+			self.x = (x + y + z)
+			self.y = (x + y + z)
+			self.colorMode = "xy"
+			self.notifyChange()
 		
 	def doCallback(self):
 		if (self.deviceType == "extendedcolor"):
 			self.callback(self.val, self.getColorRGB())
 		else:
 			self.callback(self.val)
-			
+
+class EspalexaEventSubscriber:
+	def __init__(self):
+		#pending deltas keyed by device index, a slow client gets them merged into one delta per device
+		#so the buffer never holds more entries than there are devices
+		self.pending = OrderedDict()
+		self.cond = threading.Condition()
+
+	def put(self, seq, idx, delta):
+		with self.cond:
+			if idx in self.pending:
+				merged = self.pending.pop(idx)[1]
+				if not ("changed" in delta):
+					merged.pop("changed", None)	#the latest change didn't come from Alexa
+				merged.update(delta)
+			else:
+				merged = dict(delta)
+			self.pending[idx] = (seq, merged)
+			self.cond.notify()
+
+	def take(self, timeout):
+		with self.cond:
+			if not (self.pending):
+				self.cond.wait(timeout)
+			batch = list(self.pending.values())
+			self.pending.clear()
+			return batch
+
+class EspalexaEventStream:
+	def __init__(self, HISTORY = 64):
+		self.epoch = uuid4().hex[:8]	#part of every event id, ids from a previous run never match
+		self.seq = 0
+		self.history = deque(maxlen = HISTORY)
+		self.lastState = {}
+		self.subscribers = []
+		self.lock = threading.Lock()
+
+	#last: previously published state, its rgb is reused if none of the colour inputs changed
+	def deviceState(self, dev, last):
+		state = {"name": dev.getName(), "on": bool(dev.getValue()), "bri": dev.getValue()}
+		if (dev.getType() == "whitespectrum") or (dev.getType() == "color") or (dev.getType() == "extendedcolor"):
+			state["colormode"] = dev.getColorMode()
+			state["ct"] = dev.getCt()
+			state["hue"] = dev.getHue()
+			state["sat"] = dev.getSat()
+			state["xy"] = [dev.getX(), dev.getY()]
+			same = (last.get("rgb") is not None)
+			for key in ("colormode", "ct", "hue", "sat", "xy"):
+				if not (last.get(key) == state[key]):
+					same = False
+			if (state["colormode"] == "xy") and not (last.get("bri") == state["bri"]):
+				same = False	#xy brightness is part of the rgb value
+			if (same):
+				state["rgb"] = last["rgb"]
+			else:
+				try:
+					state["rgb"] = dev.getColorRGB()
+				except (ArithmeticError, ValueError):
+					state["rgb"] = None	#e.g. y = 0 or ct = 0 can't be converted
+		return state
+
+	def addDevice(self, dev):
+		with self.lock:
+			self.lastState[dev.getId()] = self.deviceState(dev, {})
+		dev.setListener(self.publish)
+
+	#called by the device after a change, only the properties that differ from the last published state are sent
+	#alexa: the change came from an Alexa request, only then "changed" (getLastChangedProperty()) is included
+	def publish(self, dev, alexa = False):
+		idx = dev.getId()
+		with self.lock:
+			last = self.lastState.get(idx, {})
+			state = self.deviceState(dev, last)
+			delta = {}
+			for key in state:
+				if not (last.get(key) == state[key]):
+					delta[key] = state[key]
+			if not (delta):
+				return
+			delta["id"] = idx + 1
+			if (alexa):
+				delta["changed"] = dev.getLastChangedProperty()
+			self.lastState[idx] = state
+			self.seq = self.seq + 1
+			self.history.append((self.seq, idx, delta))
+			for sub in self.subscribers:
+				sub.put(self.seq, idx, delta)
+
+	def eventId(self, seq):
+		return self.epoch + "-" + str(seq)
+
+	#returns the sequence number of an event id, None if it is malformed or from another run
+	def parseEventId(self, eventId):
+		if (eventId is None):
+			return None
+		epoch, sep, seq = eventId.partition("-")
+		if not (epoch == self.epoch) or not (seq.isdigit()):
+			return None
+		return int(seq)
+
+	#since: last sequence number the client has seen (None for a new client)
+	#replays the missed deltas if they are still in the history, otherwise sends the full state of every device
+	def subscribe(self, since = None):
+		sub = EspalexaEventSubscriber()
+		with self.lock:
+			oldest = self.history[0][0] if (self.history) else self.seq + 1
+			if (since is not None) and (since <= self.seq) and (since >= oldest - 1):
+				for seq, idx, delta in self.history:
+					if (seq > since):
+						sub.put(seq, idx, delta)
+			else:
+				for idx in self.lastState:
+					state = dict(self.lastState[idx])
+					state["id"] = idx + 1
+					sub.put(self.seq, idx, state)
+			self.subscribers.append(sub)
+		return sub
+
+	def unsubscribe(self, sub):
+		with self.lock:
+			if (sub in self.subscribers):
+				self.subscribers.remove(sub)
+
 class Espalexa:
-	def __init__(self, MAXDEVICES = 10, DEBUG = False):
+	def __init__(self, MAXDEVICES = 10, DEBUG = False, EVENTHISTORY = 64):
 		self.currentDeviceCount = 0
 		self.ufpConnected = False
 		self.escapedMac = ""
@@ -226,7 +392,10 @@ class Espalexa:
 		self.MCAST_PORT = 1900
 		self.MAXDEVICES = MAXDEVICES
 		self.DEBUG = DEBUG
-		
+		self.events = EspalexaEventStream(EVENTHISTORY)
+		self.EVENTKEEPALIVE = 15	#seconds between keepalive comments on an idle event stream
+		self.controlLock = threading.Lock()	#the http server is threaded, Alexa requests are still applied one at a time
+
 	def getTypeNumber(self, s):
 		if (s == "onoff"):
 			return 0
@@ -304,6 +473,9 @@ class Espalexa:
 			if (path == "/espalexa"):
 				self.outer.servePage(self)
 				return
+			elif (urlsplit(path).path == "/espalexa/events"):
+				self.outer.serveEvents(self)
+				return
 			elif (path == "/description.xml"):
 				self.outer.serveDescription(self)
 				return
@@ -374,6 +546,36 @@ class Espalexa:
 		handler.end_headers()
 		handler.wfile.write(res.encode('utf-8'))
 		
+	#Server-Sent Events stream of device changes, every event carries only the changed properties
+	#a client resumes after a reconnect with the Last-Event-ID header or /espalexa/events?since=<event id>, since wins if both are given
+	def serveEvents(self, handler):
+		if (self.DEBUG):
+			print("HTTP Req espalexa events...")
+		since = handler.headers.get('Last-Event-ID')
+		query = parse_qs(urlsplit(handler.path).query)
+		if ("since" in query):
+			since = query["since"][0]
+		sub = self.events.subscribe(self.events.parseEventId(since))
+		try:
+			#a client that vanished without closing the connection would block a write forever
+			handler.connection.settimeout(self.EVENTKEEPALIVE * 2)
+			handler.send_response(200)
+			handler.send_header('Content-type', 'text/event-stream')
+			handler.send_header('Cache-Control', 'no-cache')
+			handler.end_headers()
+			while True:
+				batch = sub.take(self.EVENTKEEPALIVE)
+				if not (batch):
+					handler.wfile.write((": keepalive\n\n").encode('utf-8'))	#also detects closed connections
+				for seq, delta in batch:
+					handler.wfile.write(("id: " + self.events.eventId(seq) + "\ndata: " + json.dumps(delta, separators = (',', ':')) + "\n\n").encode('utf-8'))
+				handler.wfile.flush()
+		except OSError:	#includes ConnectionError and socket.timeout
+			if (self.DEBUG):
+				print("Events client disconnected")
+		finally:
+			self.events.unsubscribe(sub)
+		
 	def serveDescription(self, handler):
 		if (self.DEBUG):
 			print("# Responding to description.xml ... #")
@@ -406,7 +608,7 @@ class Espalexa:
 	
 	def startHttpServer(self):
 		self.httpHandler.outer = self
-		self.server = HTTPServer(('', 80), self.httpHandler)
+		self.server = ThreadingHTTPServer(('', 80), self.httpHandler)	#threaded so long-lived event streams don't block Alexa
 		tServer = threading.Thread(target = self.server.serve_forever)
 		tServer.daemon = True
 		tServer.start()
@@ -483,6 +685,7 @@ class Espalexa:
 		dev = EspalexaDevice(deviceName, callback, deviceType, initialValue)
 		dev.setID(self.currentDeviceCount)
 		self.devices.append(dev)
+		self.events.addDevice(dev)
 		self.currentDeviceCount = self.currentDeviceCount + 1
 		return True	
 	
@@ -524,32 +727,33 @@ class Espalexa:
 			if (devId >= self.currentDeviceCount):
 				return True
 			#0: initial 1: on 2: off 3: bri 4: hs 5: ct 6: xy				
-			self.devices[devId].setPropertyChanged(0)
-			if (body.find("false") > 0):
-				self.devices[devId].setValue(0)
-				self.devices[devId].setPropertyChanged(2)
+			with self.controlLock:
+				with self.devices[devId].alexaUpdate():
+					self.devices[devId].setPropertyChanged(0)
+					if (body.find("false") > 0):
+						self.devices[devId].setValue(0)
+						self.devices[devId].setPropertyChanged(2)
+					else:
+						if (body.find("true") > 0):
+							self.devices[devId].setValue(self.devices[devId].getLastValue())
+							self.devices[devId].setPropertyChanged(1)
+						if (body.find("bri") > 0):
+							briL = int(body[(body.find("bri") + 5):].split('}')[0])
+							if (briL == 255):
+								self.devices[devId].setValue(255)
+							else:
+								self.devices[devId].setValue(briL + 1)
+							self.devices[devId].setPropertyChanged(3)
+						if (body.find("xy") > 0):
+							self.devices[devId].setColorXY(float(body[(body.find("[") + 1):(body.find("[") + 1) + 5]), float(body[(body.find(",0") + 1):(body.find(",0") + 1) + 5]))
+							self.devices[devId].setPropertyChanged(6)
+						if (body.find("hue") > 0):
+							self.devices[devId].setColor(int(body[(body.find("hue") + 5):].split(',')[0]), int(body[(body.find("sat") + 5):].split('}')[0]))
+							self.devices[devId].setPropertyChanged(4)
+						if (body.find("ct") > 0):
+							self.devices[devId].setColorCT(int(body[(body.find("ct") + 4):].split('}')[0]))
+							self.devices[devId].setPropertyChanged(5)
 				self.devices[devId].doCallback()
-				return True
-			if (body.find("true") > 0):
-				self.devices[devId].setValue(self.devices[devId].getLastValue())
-				self.devices[devId].setPropertyChanged(1)
-			if (body.find("bri") > 0):
-				briL = int(body[(body.find("bri") + 5):].split('}')[0])
-				if (briL == 255):
-					self.devices[devId].setValue(255)
-				else:
-					self.devices[devId].setValue(briL + 1)
-				self.devices[devId].setPropertyChanged(3)
-			if (body.find("xy") > 0):
-				self.devices[devId].setColorXY(float(body[(body.find("[") + 1):(body.find("[") + 1) + 5]), float(body[(body.find(",0") + 1):(body.find(",0") + 1) + 5]))
-				self.devices[devId].setPropertyChanged(6)
-			if (body.find("hue") > 0):
-				self.devices[devId].setColor(int(body[(body.find("hue") + 5):].split(',')[0]), int(body[(body.find("sat") + 5):].split('}')[0]))
-				self.devices[devId].setPropertyChanged(4)				
-			if (body.find("ct") > 0):
-				self.devices[devId].setColorCT(int(body[(body.find("ct") + 4):].split('}')[0]))
-				self.devices[devId].setPropertyChanged(5)
-			self.devices[devId].doCallback()
 			return True
 		if (self.DEBUG):
 			print("- Checked CONTROL request")
@@ -0,0 +1,205 @@
+import io
+import unittest
+
+from espalexa import Espalexa
+
+class FakeHandler:
+	def __init__(self):
+		self.wfile = io.BytesIO()
+
+	def send_response(self, code):
+		pass
+
+	def send_header(self, key, value):
+		pass
+
+	def end_headers(self):
+		pass
+
+#accepts a number of writes, then behaves like a client that went away
+class ClosingWriter:
+	def __init__(self, writes):
+		self.writes = writes
+		self.chunks = []
+
+	def write(self, data):
+		if (len(self.chunks) >= self.writes):
+			raise BrokenPipeError()
+		self.chunks.append(data.decode('utf-8'))
+
+	def flush(self):
+		pass
+
+class FakeConnection:
+	def __init__(self):
+		self.timeout = None
+
+	def settimeout(self, timeout):
+		self.timeout = timeout
+
+class FakeStreamHandler(FakeHandler):
+	def __init__(self, path, headers, writes):
+		self.path = path
+		self.headers = headers
+		self.wfile = ClosingWriter(writes)
+		self.connection = FakeConnection()
+
+class EventStreamTest(unittest.TestCase):
+	def setUp(self):
+		self.espalexa = Espalexa(EVENTHISTORY = 4)
+		self.espalexa.EVENTKEEPALIVE = 0.01
+		self.espalexa.addDevice("Light", lambda brightness: None, "dimmable")
+		self.espalexa.addDevice("Color light", lambda brightness, rgb: None, "extendedcolor")
+		self.light = self.espalexa.devices[0]
+		self.colorLight = self.espalexa.devices[1]
+
+	def alexaCall(self, idx, body):
+		req = "/api/user/lights/" + str(self.espalexa.encodeLightId(idx + 1)) + "/state"
+		self.espalexa.handleAlexaApiCall(req, body, FakeHandler())
+
+	def stream(self, path, headers, writes):
+		handler = FakeStreamHandler(path, headers, writes)
+		self.espalexa.serveEvents(handler)
+		return handler
+
+	def test_new_subscriber_gets_snapshot(self):
+		self.light.setValue(42)
+		sub = self.espalexa.events.subscribe()
+		batch = sub.take(0)
+		self.assertEqual(len(batch), 2)
+		self.assertEqual(batch[0][1]["id"], 1)
+		self.assertEqual(batch[0][1]["name"], "Light")
+		self.assertEqual(batch[0][1]["bri"], 42)
+		self.assertEqual(batch[1][1]["colormode"], "xy")
+		self.assertNotIn("changed", batch[0][1])
+
+	def test_slow_subscriber_gets_merged_delta(self):
+		sub = self.espalexa.events.subscribe(0)
+		self.light.setValue(10)
+		self.colorLight.setColor(100, 200)
+		self.light.setValue(20)
+		self.light.setName("Lamp")
+		batch = sub.take(0)
+		self.assertEqual(len(batch), 2)
+		self.assertEqual(batch[0], (2, {"hue": 100, "sat": 200, "colormode": "hs", "rgb": (255 << 16) | (56 << 8) | 55, "id": 2}))
+		self.assertEqual(batch[1], (4, {"on": True, "bri": 20, "name": "Lamp", "id": 1}))
+		self.assertEqual(sub.take(0), [])
+
+	def test_local_change_drops_merged_alexa_changed(self):
+		sub = self.espalexa.events.subscribe(0)
+		self.alexaCall(0, "{\"on\":true,\"bri\":100}")
+		self.light.setValue(20)
+		self.assertEqual(sub.take(0), [(2, {"on": True, "bri": 20, "id": 1})])
+
+	def test_alexa_change_keeps_changed_when_merged(self):
+		sub = self.espalexa.events.subscribe(0)
+		self.light.setValue(20)
+		self.alexaCall(0, "{\"bri\":100}")
+		self.assertEqual(sub.take(0), [(2, {"on": True, "bri": 101, "id": 1, "changed": 3})])
+
+	def test_unchanged_value_publishes_nothing(self):
+		sub = self.espalexa.events.subscribe(0)
+		self.light.setValue(0)
+		self.assertEqual(sub.take(0), [])
+
+	def test_resume_inside_history(self):
+		self.light.setValue(10)
+		self.light.setValue(20)
+		self.light.setValue(30)
+		sub = self.espalexa.events.subscribe(2)
+		self.assertEqual(sub.take(0), [(3, {"bri": 30, "id": 1})])
+
+	def test_resume_outside_history_gets_snapshot(self):
+		for val in range(1, 7):
+			self.light.setValue(val)
+		sub = self.espalexa.events.subscribe(1)
+		batch = sub.take(0)
+		self.assertEqual(len(batch), 2)
+		self.assertEqual(batch[0][0], 6)
+		self.assertEqual(batch[0][1]["bri"], 6)
+		self.assertIn("name", batch[0][1])
+
+	def test_resume_unknown_sequence_gets_snapshot(self):
+		sub = self.espalexa.events.subscribe(99)
+		self.assertEqual(len(sub.take(0)), 2)
+
+	def test_resume_with_id_from_previous_instance(self):
+		previous = Espalexa()
+		previous.addDevice("Light", lambda brightness: None, "dimmable")
+		for val in range(1, 4):
+			previous.devices[0].setValue(val)
+		for val in range(10, 14):
+			self.light.setValue(val)
+		events = self.espalexa.events
+		self.assertIsNone(events.parseEventId(previous.events.eventId(3)))
+		batch = events.subscribe(events.parseEventId(previous.events.eventId(3))).take(0)
+		self.assertEqual(len(batch), 2)
+		self.assertEqual(batch[0][1]["bri"], 13)
+		self.assertIn("name", batch[0][1])
+
+	def test_parse_event_id(self):
+		events = self.espalexa.events
+		self.assertEqual(events.parseEventId(events.eventId(7)), 7)
+		self.assertIsNone(events.parseEventId(None))
+		self.assertIsNone(events.parseEventId("7"))
+		self.assertIsNone(events.parseEventId(events.epoch + "-abc"))
+
+	def test_serve_events_framing(self):
+		self.light.setValue(42)
+		handler = self.stream("/espalexa/events", {}, 2)
+		self.assertEqual(handler.connection.timeout, self.espalexa.EVENTKEEPALIVE * 2)
+		self.assertEqual(handler.wfile.chunks[0], "id: " + self.espalexa.events.eventId(1) + "\ndata: {\"name\":\"Light\",\"on\":true,\"bri\":42,\"id\":1}\n\n")
+		self.assertTrue(handler.wfile.chunks[1].startswith("id: " + self.espalexa.events.eventId(1) + "\ndata: {\"name\":\"Color light\""))
+
+	def test_serve_events_resume_with_last_event_id(self):
+		self.light.setValue(10)
+		self.light.setValue(20)
+		handler = self.stream("/espalexa/events", {"Last-Event-ID": self.espalexa.events.eventId(1)}, 1)
+		self.assertEqual(handler.wfile.chunks, ["id: " + self.espalexa.events.eventId(2) + "\ndata: {\"bri\":20,\"id\":1}\n\n"])
+
+	def test_serve_events_since_wins_over_last_event_id(self):
+		self.light.setValue(10)
+		self.light.setValue(20)
+		self.light.setValue(30)
+		path = "/espalexa/events?since=" + self.espalexa.events.eventId(2)
+		handler = self.stream(path, {"Last-Event-ID": self.espalexa.events.eventId(1)}, 1)
+		self.assertEqual(handler.wfile.chunks, ["id: " + self.espalexa.events.eventId(3) + "\ndata: {\"bri\":30,\"id\":1}\n\n"])
+
+	def test_serve_events_invalid_since_gets_snapshot(self):
+		self.light.setValue(10)
+		handler = self.stream("/espalexa/events?since=abc", {}, 2)
+		self.assertIn("\"name\":\"Light\"", handler.wfile.chunks[0])
+		self.assertIn("\"name\":\"Color light\"", handler.wfile.chunks[1])
+
+	def test_serve_events_keepalive_and_disconnect(self):
+		handler = self.stream("/espalexa/events?since=" + self.espalexa.events.eventId(0), {}, 1)
+		self.assertEqual(handler.wfile.chunks, [": keepalive\n\n"])
+		self.assertEqual(self.espalexa.events.subscribers, [])
+
+	def test_alexa_request_is_one_event(self):
+		sub = self.espalexa.events.subscribe(0)
+		self.alexaCall(1, "{\"on\":true,\"bri\":100}")
+		batch = sub.take(0)
+		self.assertEqual(len(batch), 1)
+		self.assertEqual(batch[0][0], 1)
+		delta = batch[0][1]
+		self.assertEqual(delta["on"], True)
+		self.assertEqual(delta["bri"], 101)
+		self.assertIn("rgb", delta)
+		self.assertEqual(delta["changed"], 3)
+
+	def test_malformed_alexa_request_does_not_mute_device(self):
+		sub = self.espalexa.events.subscribe(0)
+		with self.assertRaises(ValueError):
+			self.alexaCall(0, "{\"bri\":abc}")
+		self.light.setValue(5)
+		self.assertEqual(sub.take(0), [(1, {"on": True, "bri": 5, "id": 1})])
+
+	def test_unconvertible_color_does_not_raise(self):
+		sub = self.espalexa.events.subscribe(0)
+		self.colorLight.setColorXY(0.3, 0)
+		self.colorLight.setColorCT(0)
+		self.assertIsNone(sub.take(0)[0][1]["rgb"])
+
+if __name__ == "__main__":
+	unittest.main()